@@ -40,4 +40,19 @@ class TestConnectionResponse(BaseModel):
     success: bool
     provider: Optional[str] = None
     message: str
-    error: Optional[Any] = None
\ No newline at end of file
+    error: Optional[Any] = None
+
+class OperationUsage(BaseModel):
+    operation: str
+    calls: int
+    inputTokens: int
+    outputTokens: int
+    reservedTokens: int
+    truncatedCalls: int
+    avgLatencyMs: float
+    p95LatencyMs: float
+
+class UsageResponse(BaseModel):
+    apiKeyHash: str
+    provider: str
+    operations: List[OperationUsage] = []
\ No newline at end of file
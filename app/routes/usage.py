@@ -0,0 +1,21 @@
+from fastapi import APIRouter, HTTPException, Body
+from app.models.api_models import ApiConfig, UsageResponse
+from app.services.ai_service import AIService
+
+router = APIRouter()
+
+@router.post("/usage", response_model=UsageResponse)
+async def get_usage(config: ApiConfig = Body(...)):
+    """Get recorded token usage and latency for the provided API key"""
+    try:
+        # Only report usage for a key the caller supplied, never the server's default key
+        api_key = config.anthropicApiKey if config.preferredProvider == "anthropic" else config.openaiApiKey
+        if not api_key or api_key.strip() == "":
+            raise HTTPException(status_code=400, detail="API key is required")
+        
+        ai_service = AIService(config)
+        return await ai_service.get_usage_summary()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -1,9 +1,16 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import uuid
 import json
 import re
 import os
+import asyncio
+import sqlite3
+import time
 from app.models.api_models import ContentIdea, VideoScript, LinkedInPost, ApiConfig
+from app.services.usage_ledger import default_max_tokens, fit_context_window, get_usage_ledger, hash_api_key
+
+# Context window of the OpenAI model; prompt plus max_tokens must fit inside it
+OPENAI_CONTEXT_TOKENS = 8192
 
 class AIService:
     def __init__(self, config: ApiConfig):
@@ -12,6 +19,7 @@ class AIService:
         # Initialize clients based on provided API keys
         self.anthropic_client = None
         self.openai_client = None
+        self.api_key_hash = None
         
         if config.preferredProvider == "anthropic":
             api_key = config.anthropicApiKey or os.getenv("ANTHROPIC_API_KEY")
@@ -19,6 +27,7 @@ class AIService:
                 try:
                     import anthropic
                     self.anthropic_client = anthropic.Anthropic(api_key=api_key)
+                    self.api_key_hash = hash_api_key(api_key)
                 except ImportError:
                     raise ValueError("Anthropic SDK not installed properly. Install with: pip install anthropic>=0.19.1")
             else:
@@ -29,6 +38,7 @@ class AIService:
                 try:
                     import openai
                     self.openai_client = openai.OpenAI(api_key=api_key)
+                    self.api_key_hash = hash_api_key(api_key)
                 except ImportError:
                     raise ValueError("OpenAI SDK not installed properly.")
             else:
@@ -84,8 +94,8 @@ class AIService:
                 "error": str(e)
             }
     
-    async def _get_anthropic_response(self, prompt_content: str, max_tokens: int = 1000, temperature: float = 0.7) -> str:
-        """Helper method to get a response from Anthropic using the Messages API"""
+    async def _get_anthropic_response(self, prompt_content: str, max_tokens: int = 1000, temperature: float = 0.7) -> Tuple[str, int, int, bool]:
+        """Helper method to get a response and its token usage from Anthropic using the Messages API"""
         message = self.anthropic_client.messages.create(
             model="claude-3-7-sonnet-20250219",  # Latest Claude model
             max_tokens=max_tokens,
@@ -95,7 +105,80 @@ class AIService:
             ]
         )
         
-        return message.content[0].text
+        return (
+            message.content[0].text,
+            message.usage.input_tokens,
+            message.usage.output_tokens,
+            message.stop_reason == "max_tokens"
+        )
+    
+    async def _get_openai_response(self, prompt_content: str, max_tokens: int = 1000, temperature: float = 0.7) -> Tuple[str, int, int, bool]:
+        """Helper method to get a response and its token usage from OpenAI using the Chat Completions API"""
+        completion = self.openai_client.chat.completions.create(
+            model="gpt-4",
+            messages=[{"role": "user", "content": prompt_content}],
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        
+        choice = completion.choices[0]
+        return (
+            choice.message.content,
+            completion.usage.prompt_tokens,
+            completion.usage.completion_tokens,
+            choice.finish_reason == "length"
+        )
+    
+    async def _generate_text(self, prompt: str, operation: str, temperature: float = 0.7) -> str:
+        """Generate text with a max_tokens budget sized from past usage, and record the call in the usage ledger"""
+        ledger = None
+        try:
+            ledger = await asyncio.to_thread(get_usage_ledger)
+            max_tokens = await asyncio.to_thread(ledger.suggest_max_tokens, self.api_key_hash, operation, len(prompt))
+        except sqlite3.Error:
+            # Fall back to the fixed budget if the ledger is unavailable
+            max_tokens = default_max_tokens(operation)
+        
+        if self.config.preferredProvider == "openai":
+            max_tokens = fit_context_window(max_tokens, len(prompt), OPENAI_CONTEXT_TOKENS)
+        
+        start = time.perf_counter()
+        if self.config.preferredProvider == "anthropic" and self.anthropic_client:
+            text, input_tokens, output_tokens, truncated = await self._get_anthropic_response(prompt, max_tokens, temperature)
+        elif self.config.preferredProvider == "openai" and self.openai_client:
+            text, input_tokens, output_tokens, truncated = await self._get_openai_response(prompt, max_tokens, temperature)
+        else:
+            raise ValueError("No valid AI provider configured")
+        latency_ms = (time.perf_counter() - start) * 1000
+        
+        try:
+            if ledger is not None:
+                await asyncio.to_thread(
+                    ledger.record,
+                    api_key_hash=self.api_key_hash,
+                    provider=self.config.preferredProvider,
+                    operation=operation,
+                    input_chars=len(prompt),
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens,
+                    max_tokens=max_tokens,
+                    truncated=truncated,
+                    latency_ms=latency_ms
+                )
+        except sqlite3.Error:
+            # A ledger failure should never fail the generation itself
+            pass
+        
+        return text
+    
+    async def get_usage_summary(self) -> Dict[str, Any]:
+        """Return recorded token usage and latency per operation for the configured API key"""
+        ledger = await asyncio.to_thread(get_usage_ledger)
+        return {
+            "apiKeyHash": self.api_key_hash,
+            "provider": self.config.preferredProvider,
+            "operations": await asyncio.to_thread(ledger.summary, self.api_key_hash)
+        }
     
     async def generate_content_ideas(self, transcript: str, instructions: str = "") -> List[ContentIdea]:
         """Generate content ideas from transcript"""
@@ -125,20 +208,7 @@ Example format:
 ]
 """
         try:
-            text = ""
-            # Generate text based on provider
-            if self.config.preferredProvider == "anthropic" and self.anthropic_client:
-                text = await self._get_anthropic_response(prompt, 1000, 0.7)
-            elif self.config.preferredProvider == "openai" and self.openai_client:
-                completion = self.openai_client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=1000,
-                    temperature=0.7
-                )
-                text = completion.choices[0].message.content
-            else:
-                raise ValueError("No valid AI provider configured")
+            text = await self._generate_text(prompt, "content_ideas", 0.7)
             
             # Parse response
             return self._parse_content_ideas_response(text)
@@ -207,20 +277,7 @@ Create a well-structured blog-style script that includes:
 Format your response as a well-structured blog post that could be read as a script. Use a conversational tone throughout.
 """
         try:
-            text = ""
-            # Generate text based on provider
-            if self.config.preferredProvider == "anthropic" and self.anthropic_client:
-                text = await self._get_anthropic_response(prompt, 2000, 0.7)
-            elif self.config.preferredProvider == "openai" and self.openai_client:
-                completion = self.openai_client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=2000,
-                    temperature=0.7
-                )
-                text = completion.choices[0].message.content
-            else:
-                raise ValueError("No valid AI provider configured")
+            text = await self._generate_text(prompt, "video_script", 0.7)
             
             if not text or text.strip() == "":
                 raise ValueError("Received empty response from AI service")
@@ -249,20 +306,7 @@ REFINEMENT INSTRUCTIONS:
 Please provide the complete refined script. Keep what works well from the original and modify only what needs to be changed according to the instructions.
 """
         try:
-            text = ""
-            # Generate text based on provider
-            if self.config.preferredProvider == "anthropic" and self.anthropic_client:
-                text = await self._get_anthropic_response(prompt, 2000, 0.7)
-            elif self.config.preferredProvider == "openai" and self.openai_client:
-                completion = self.openai_client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=2000,
-                    temperature=0.7
-                )
-                text = completion.choices[0].message.content
-            else:
-                raise ValueError("No valid AI provider configured")
+            text = await self._generate_text(prompt, "refine_script", 0.7)
             
             if not text or text.strip() == "":
                 raise ValueError("Received empty response from AI service")
@@ -301,20 +345,7 @@ Create a well-structured blog-style script that includes:
 Format your response as a well-structured blog post that could be read as a script. Use a conversational tone throughout.
 """
         try:
-            text = ""
-            # Generate text based on provider
-            if self.config.preferredProvider == "anthropic" and self.anthropic_client:
-                text = await self._get_anthropic_response(prompt, 2000, 0.7)
-            elif self.config.preferredProvider == "openai" and self.openai_client:
-                completion = self.openai_client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=2000,
-                    temperature=0.7
-                )
-                text = completion.choices[0].message.content
-            else:
-                raise ValueError("No valid AI provider configured")
+            text = await self._generate_text(prompt, "regenerate_script", 0.7)
             
             if not text or text.strip() == "":
                 raise ValueError("Received empty response from AI service")
@@ -348,20 +379,7 @@ Create a LinkedIn post that:
 Format your response as a ready-to-post LinkedIn update. Do not include any explanations or additional text outside the post.
 """
         try:
-            text = ""
-            # Generate text based on provider
-            if self.config.preferredProvider == "anthropic" and self.anthropic_client:
-                text = await self._get_anthropic_response(prompt, 1000, 0.7)
-            elif self.config.preferredProvider == "openai" and self.openai_client:
-                completion = self.openai_client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=1000,
-                    temperature=0.7
-                )
-                text = completion.choices[0].message.content
-            else:
-                raise ValueError("No valid AI provider configured")
+            text = await self._generate_text(prompt, "linkedin_post", 0.7)
             
             if not text or text.strip() == "":
                 raise ValueError("Received empty response from AI service")
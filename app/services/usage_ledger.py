@@ -0,0 +1,262 @@
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from contextlib import contextmanager
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+# Per-operation budget policy used to pick max_tokens.
+# default: fixed budget used until there is enough history (and if the ledger is unavailable)
+# floor/ceiling: bounds for the max_tokens value once history is used
+BUDGET_POLICIES: Dict[str, Dict[str, int]] = {
+    "content_ideas": {"default": 1000, "floor": 400, "ceiling": 2000},
+    "video_script": {"default": 2000, "floor": 800, "ceiling": 4096},
+    "refine_script": {"default": 2000, "floor": 800, "ceiling": 4096},
+    "regenerate_script": {"default": 2000, "floor": 800, "ceiling": 4096},
+    "linkedin_post": {"default": 1000, "floor": 300, "ceiling": 1500},
+}
+DEFAULT_POLICY: Dict[str, int] = {"default": 2000, "floor": 500, "ceiling": 4096}
+
+# Number of recent calls considered, and how many completed calls are needed before history is trusted
+HISTORY_WINDOW = 50
+MIN_SAMPLES = 5
+# Headroom applied on top of the observed p95 output
+HEADROOM = 1.2
+# Output is only modelled as growing with input when a linear fit explains at least this share of its variance
+GROWTH_MIN_R2 = 0.5
+# Growth applied to the budget of a call that hit max_tokens
+TRUNCATION_GROWTH = 1.5
+# Number of recent calls per operation used for the p95 latency in usage summaries
+SUMMARY_LATENCY_WINDOW = 200
+# Conservative prompt size estimate used to keep max_tokens inside a model's context window
+CHARS_PER_TOKEN = 3.5
+PROMPT_TOKEN_OVERHEAD = 50
+
+def hash_api_key(api_key: str) -> str:
+    """Return a stable, non-reversible identifier for an API key"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+def default_max_tokens(operation: str) -> int:
+    """Return the fixed max_tokens budget for an operation"""
+    return BUDGET_POLICIES.get(operation, DEFAULT_POLICY)["default"]
+
+def fit_context_window(max_tokens: int, input_chars: int, context_tokens: int) -> int:
+    """Cap max_tokens so the estimated prompt plus the completion fits in the model's context"""
+    prompt_tokens = int(math.ceil(input_chars / CHARS_PER_TOKEN)) + PROMPT_TOKEN_OVERHEAD
+    return max(1, min(max_tokens, context_tokens - prompt_tokens))
+
+def _percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def _linear_fit(xs: List[float], ys: List[float]) -> Optional[Tuple[float, float, float]]:
+    """Least-squares fit of ys against xs, returning (slope, intercept, r_squared)"""
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    syy = sum((y - mean_y) ** 2 for y in ys)
+    if sxx == 0 or syy == 0:
+        return None
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    slope = sxy / sxx
+    return slope, mean_y - slope * mean_x, sxy * sxy / (sxx * syy)
+
+class UsageLedger:
+    """Local SQLite ledger of token usage and latency per API key and operation"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.enabled = True
+        try:
+            self._init_db()
+        except sqlite3.Error:
+            # Generation keeps working with fixed budgets if the ledger can't be opened
+            self.enabled = False
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    api_key_hash TEXT NOT NULL,
+                    provider TEXT NOT NULL,
+                    operation TEXT NOT NULL,
+                    input_chars INTEGER NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    max_tokens INTEGER NOT NULL,
+                    truncated INTEGER NOT NULL DEFAULT 0,
+                    latency_ms REAL NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_usage_key_operation "
+                "ON usage (api_key_hash, operation, id)"
+            )
+
+    def record(
+        self,
+        api_key_hash: str,
+        provider: str,
+        operation: str,
+        input_chars: int,
+        input_tokens: int,
+        output_tokens: int,
+        max_tokens: int,
+        truncated: bool,
+        latency_ms: float,
+    ) -> None:
+        """Store a single provider call"""
+        if not self.enabled:
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO usage (
+                    api_key_hash, provider, operation, input_chars, input_tokens,
+                    output_tokens, max_tokens, truncated, latency_ms, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    api_key_hash, provider, operation, input_chars, input_tokens,
+                    output_tokens, max_tokens, int(truncated), latency_ms, time.time(),
+                ),
+            )
+
+    def _recent_calls(self, api_key_hash: Optional[str], operation: str) -> List[sqlite3.Row]:
+        query = "SELECT id, input_chars, output_tokens, max_tokens, truncated FROM usage WHERE operation = ?"
+        params: List[Any] = [operation]
+        if api_key_hash is not None:
+            query += " AND api_key_hash = ?"
+            params.append(api_key_hash)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(HISTORY_WINDOW)
+        with self._connect() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def suggest_max_tokens(self, api_key_hash: str, operation: str, input_chars: int) -> int:
+        """Pick max_tokens for a call from the input length and observed outputs.
+
+        Uses this key's history for the operation, falling back to all keys, and
+        keeps the fixed default budget until there are enough completed calls.
+        """
+        policy = BUDGET_POLICIES.get(operation, DEFAULT_POLICY)
+        if not self.enabled:
+            return policy["default"]
+
+        rows = self._recent_calls(api_key_hash, operation)
+        if sum(1 for row in rows if not row["truncated"]) < MIN_SAMPLES:
+            rows = self._recent_calls(None, operation)
+        # Truncated calls only report the budget they were cut off at, not what they needed
+        completed = [row for row in rows if not row["truncated"]]
+
+        if len(completed) < MIN_SAMPLES:
+            budget = policy["default"]
+        else:
+            budget = self._predict_output(completed, input_chars) * HEADROOM
+            budget = max(policy["floor"], min(policy["ceiling"], int(math.ceil(budget))))
+
+        # A truncation raises the budget until a later call completes with at least the
+        # same budget; a truncation at the ceiling can't be helped by a larger budget
+        for row in rows:
+            if not row["truncated"] or row["max_tokens"] >= policy["ceiling"]:
+                continue
+            resolved = any(
+                call["id"] > row["id"] and call["max_tokens"] >= row["max_tokens"]
+                for call in completed
+            )
+            if not resolved:
+                budget = max(budget, int(math.ceil(row["max_tokens"] * TRUNCATION_GROWTH)))
+
+        return min(policy["ceiling"], budget)
+
+    def _predict_output(self, completed: List[sqlite3.Row], input_chars: int) -> float:
+        """Predict the p95 output tokens for a prompt of the given length.
+
+        Uses the p95 of observed outputs unless they clearly grow with input length,
+        in which case a linear fit plus the p95 residual is used instead.
+        """
+        chars = [row["input_chars"] for row in completed]
+        outputs = [row["output_tokens"] for row in completed]
+
+        fit = _linear_fit(chars, outputs)
+        if fit is None or fit[0] <= 0 or fit[2] < GROWTH_MIN_R2:
+            return _percentile(outputs, 95)
+
+        slope, intercept, _ = fit
+        residuals = [output - (intercept + slope * x) for x, output in zip(chars, outputs)]
+        return intercept + slope * input_chars + max(0.0, _percentile(residuals, 95))
+
+    def summary(self, api_key_hash: str) -> List[Dict[str, Any]]:
+        """Aggregate usage per operation for an API key"""
+        if not self.enabled:
+            return []
+        with self._connect() as conn:
+            totals = conn.execute(
+                """
+                SELECT operation,
+                       COUNT(*) AS calls,
+                       SUM(input_tokens) AS input_tokens,
+                       SUM(output_tokens) AS output_tokens,
+                       SUM(max_tokens) AS reserved_tokens,
+                       SUM(truncated) AS truncated_calls,
+                       AVG(latency_ms) AS avg_latency_ms
+                FROM usage WHERE api_key_hash = ? GROUP BY operation ORDER BY operation
+                """,
+                (api_key_hash,),
+            ).fetchall()
+
+            result = []
+            for row in totals:
+                # p95 latency only over recent calls so the summary stays cheap as the ledger grows
+                latencies = [
+                    call["latency_ms"] for call in conn.execute(
+                        """
+                        SELECT latency_ms FROM usage WHERE api_key_hash = ? AND operation = ?
+                        ORDER BY id DESC LIMIT ?
+                        """,
+                        (api_key_hash, row["operation"], SUMMARY_LATENCY_WINDOW),
+                    )
+                ]
+                result.append({
+                    "operation": row["operation"],
+                    "calls": row["calls"],
+                    "inputTokens": row["input_tokens"],
+                    "outputTokens": row["output_tokens"],
+                    "reservedTokens": row["reserved_tokens"],
+                    "truncatedCalls": row["truncated_calls"],
+                    "avgLatencyMs": round(row["avg_latency_ms"], 1),
+                    "p95LatencyMs": round(_percentile(latencies, 95), 1),
+                })
+        return result
+
+_ledger: Optional[UsageLedger] = None
+_ledger_lock = threading.Lock()
+
+def get_usage_ledger() -> UsageLedger:
+    """Return the process-wide ledger, creating it on first use"""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger(os.getenv("USAGE_DB_PATH", "usage.db"))
+        return _ledger
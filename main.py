@@ -28,11 +28,13 @@ app.add_middleware(
 from app.routes.content_ideas import router as content_ideas_router
 from app.routes.scripts import router as scripts_router
 from app.routes.linkedin_posts import router as linkedin_posts_router
+from app.routes.usage import router as usage_router
 
 # Include routers
 app.include_router(content_ideas_router, prefix="/api", tags=["content ideas"])
 app.include_router(scripts_router, prefix="/api", tags=["scripts"])
 app.include_router(linkedin_posts_router, prefix="/api", tags=["linkedin posts"])
+app.include_router(usage_router, prefix="/api", tags=["usage"])
 
 # Health check endpoint
 @app.get("/health", tags=["health"])
@@ -0,0 +1,114 @@
+import pytest
+
+from app.services import usage_ledger
+from app.services.usage_ledger import UsageLedger, fit_context_window, hash_api_key
+
+KEY = hash_api_key("test-key")
+OTHER_KEY = hash_api_key("other-key")
+
+@pytest.fixture
+def ledger(tmp_path):
+    return UsageLedger(str(tmp_path / "usage.db"))
+
+def record(ledger, output_tokens, input_chars=3000, max_tokens=2000, truncated=False,
+           key=KEY, operation="video_script", latency_ms=1000.0):
+    ledger.record(
+        api_key_hash=key,
+        provider="anthropic",
+        operation=operation,
+        input_chars=input_chars,
+        input_tokens=input_chars // 4,
+        output_tokens=output_tokens,
+        max_tokens=max_tokens,
+        truncated=truncated,
+        latency_ms=latency_ms,
+    )
+
+def test_cold_start_uses_fixed_defaults(ledger):
+    assert ledger.suggest_max_tokens(KEY, "content_ideas", 2000) == 1000
+    assert ledger.suggest_max_tokens(KEY, "linkedin_post", 500) == 1000
+    assert ledger.suggest_max_tokens(KEY, "video_script", 2000) == 2000
+    assert ledger.suggest_max_tokens(KEY, "video_script", 30000) == 2000
+
+def test_defaults_kept_until_min_samples(ledger):
+    for _ in range(usage_ledger.MIN_SAMPLES - 1):
+        record(ledger, 500)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 2000
+
+    record(ledger, 500)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 800  # 500 * 1.2, raised to the floor
+
+def test_falls_back_to_all_keys(ledger):
+    for _ in range(usage_ledger.MIN_SAMPLES):
+        record(ledger, 1000, key=OTHER_KEY)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 1200
+
+    # Once this key has its own history it takes precedence
+    for _ in range(usage_ledger.MIN_SAMPLES):
+        record(ledger, 1500)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 1800
+
+def test_budget_flat_when_output_independent_of_input(ledger):
+    for i in range(50):
+        record(ledger, 1200 + (i * 37) % 401, input_chars=2000 + (i * 53) % 4000)
+
+    budgets = [ledger.suggest_max_tokens(KEY, "video_script", chars) for chars in (3000, 6000, 12000, 30000)]
+    assert budgets == [budgets[0]] * 4
+    assert budgets[0] <= 1600 * usage_ledger.HEADROOM
+
+def test_budget_scales_when_output_grows_with_input(ledger):
+    for i in range(20):
+        chars = 2000 + i * 500
+        record(ledger, chars // 5 + (i % 3) * 20, input_chars=chars)
+
+    short = ledger.suggest_max_tokens(KEY, "video_script", 3000)
+    long = ledger.suggest_max_tokens(KEY, "video_script", 10000)
+    assert short < long
+    assert long >= 2000
+
+def test_truncation_raises_budget_until_resolved(ledger):
+    for _ in range(usage_ledger.MIN_SAMPLES):
+        record(ledger, 500)
+    record(ledger, 800, max_tokens=800, truncated=True)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 1200
+
+    # A later call completing with at least the truncated budget resolves it
+    record(ledger, 700, max_tokens=1200)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 840
+
+def test_truncation_at_ceiling_does_not_pin_budget(ledger):
+    record(ledger, 4096, max_tokens=4096, truncated=True)
+    for _ in range(usage_ledger.MIN_SAMPLES):
+        record(ledger, 1300)
+    assert ledger.suggest_max_tokens(KEY, "video_script", 3000) == 1560
+
+def test_disabled_ledger_uses_defaults(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "missing" / "usage.db"))
+    assert not ledger.enabled
+    record(ledger, 500)
+    assert ledger.suggest_max_tokens(KEY, "content_ideas", 2000) == 1000
+    assert ledger.summary(KEY) == []
+
+def test_summary_aggregates_per_operation(ledger):
+    record(ledger, 500, latency_ms=100.0)
+    record(ledger, 700, max_tokens=700, truncated=True, latency_ms=300.0)
+    record(ledger, 200, operation="linkedin_post", max_tokens=1000, latency_ms=50.0)
+    record(ledger, 999, key=OTHER_KEY)
+
+    summary = ledger.summary(KEY)
+    assert [entry["operation"] for entry in summary] == ["linkedin_post", "video_script"]
+
+    script = summary[1]
+    assert script["calls"] == 2
+    assert script["inputTokens"] == 1500
+    assert script["outputTokens"] == 1200
+    assert script["reservedTokens"] == 2700
+    assert script["truncatedCalls"] == 1
+    assert script["avgLatencyMs"] == 200.0
+    assert script["p95LatencyMs"] == 300.0
+
+def test_fit_context_window_caps_long_prompts():
+    assert fit_context_window(2000, 3000, 8192) == 2000
+    capped = fit_context_window(4096, 20000, 8192)
+    assert capped < 4096
+    assert capped + 20000 / usage_ledger.CHARS_PER_TOKEN < 8192